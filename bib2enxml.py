@@ -10,6 +10,8 @@ import codecs
 import unicodedata
 import string
 import textwrap
+import threading
+import Queue
 from datetime import datetime
 import logging
 
@@ -51,6 +53,306 @@ def delatex_for_xml(s):
     return xml
 
 
+# --------------------------------------------------
+
+PERSON_NAME_PARTS = ('first', 'middle', 'prelast', 'last', 'lineage')
+
+def person_name_key(person):
+    """
+    Return a hashable key made of the name parts of the pybtex `Person` `person`.
+    """
+    return tuple( tuple(person.get_part(t)) for t in PERSON_NAME_PARTS )
+
+def normalize_name_part(s):
+    """
+    Normalize a single name part for comparison: LaTeX is converted to text, accents,
+    punctuation and spaces are removed and the result is lower-cased. For example,
+    `G{\\"o}del' and `Godel' both give `godel'.
+    """
+    s = latex2text.latex2text(unicode(s), tolerant_parsing=True)
+    s = unicodedata.normalize('NFKD', s)
+    return "".join( (c for c in s.lower() if c.isalnum()) )
+
+def normalized_person_name_key(person):
+    """
+    Same as `person_name_key()`, but with each name part normalized with
+    `normalize_name_part()`, so that spelling variants of the same name give the same key.
+    """
+    return tuple(
+        tuple( (x for x in (normalize_name_part(n) for n in person.get_part(t)) if x) )
+        for t in PERSON_NAME_PARTS
+        )
+
+def person_to_xml(person):
+    return ("<author>"
+              "<style face=\"normal\" font=\"default\" size=\"100%\">" +
+                delatex_for_xml(unicode(person)) +
+              "</style>"
+            "</author>")
+
+
+class PersonXmlCache(object):
+    """
+    Cache of rendered `<author>...</author>` XML fragments, keyed by the name parts of
+    the person.
+
+    The same people typically appear in many entries of a database, so each person is
+    only rendered once per run. If `normalize_names` is `True`, then spelling variants
+    of the same name (see `normalize_name_part()`) are collapsed onto the rendering of
+    the first variant encountered.
+
+    If `max_names` is given, the cache of rendered names is emptied whenever it holds
+    that many names. The normalized names are always all kept, as they determine which
+    spelling is written out.
+    """
+    def __init__(self, normalize_names=False, max_names=None):
+        self.normalize_names = normalize_names
+        self.max_names = max_names
+        self._by_name = {}
+        self._by_normalized_name = {}
+
+    def get_xml(self, person):
+        key = person_name_key(person)
+        xml = self._by_name.get(key)
+        if xml is not None:
+            return xml
+
+        if self.normalize_names:
+            # only normalize names we haven't seen verbatim yet
+            nkey = normalized_person_name_key(person)
+            xml = self._by_normalized_name.get(nkey)
+            if xml is None:
+                xml = person_to_xml(person)
+                self._by_normalized_name[nkey] = xml
+            else:
+                logger.longdebug("Person `%s' rendered as known spelling variant %s",
+                                 unicode(person), xml)
+        else:
+            xml = person_to_xml(person)
+
+        if self.max_names is not None and len(self._by_name) >= self.max_names:
+            self._by_name = {}
+        self._by_name[key] = xml
+        return xml
+
+
+# Values such as journal names are often repeated, but most (titles, abstracts) aren't: by
+# default, only keep this many de-LaTeX'ed values.
+DEFAULT_MAX_DELATEX = 10000
+
+class RenderCache(object):
+    """
+    In-memory caches used while rendering records: de-LaTeX'ed values, rendered persons
+    and, if `cache_records` is `True`, the rendered XML of whole records. The cache of
+    de-LaTeX'ed values is emptied whenever it holds `max_delatex` values, to keep memory
+    bounded; use `max_delatex=None` for no limit. Similarly, `max_persons` bounds the
+    number of rendered persons (see `PersonXmlCache`), which is unlimited by default.
+
+    By default, each run of the filter uses its own fresh `RenderCache`. A long-running
+    process (see `bib2enxmlwatch`) may instead keep a `RenderCache` alive across runs and
+    give it to the filter with `Bib2EnXmlFilter.use_render_cache()`, so that only new or
+    modified entries have to be rendered again.
+    """
+    def __init__(self, cache_records=False, max_delatex=DEFAULT_MAX_DELATEX,
+                 max_persons=None):
+        self.delatex = {}
+        self.max_delatex = max_delatex
+        self.max_persons = max_persons
+        self.person_caches = {}
+        self.records = ({} if cache_records else None)
+        self.records_used = set()
+
+    def delatex_for_xml(self, s):
+        xml = self.delatex.get(s)
+        if xml is None:
+            xml = delatex_for_xml(s)
+            if self.max_delatex is not None and len(self.delatex) >= self.max_delatex:
+                self.delatex = {}
+            self.delatex[s] = xml
+        return xml
+
+    def person_cache(self, normalize_names):
+        pc = self.person_caches.get(normalize_names)
+        if pc is None:
+            pc = PersonXmlCache(normalize_names=normalize_names, max_names=self.max_persons)
+            self.person_caches[normalize_names] = pc
+        return pc
+
+    def begin_export(self):
+        """
+        Called at the start of each export. Forgets which spelling variant was chosen for
+        each normalized person name, so that it is again the first variant in the database
+        being exported (which may have been edited since the previous export).
+        """
+        self.person_caches.pop(True, None)
+
+    def prune_records(self, max_records=None):
+        """
+        Forget the rendered records which have not been used since the last call to
+        `prune_records()`, e.g. those of entries which have been modified or removed.
+
+        If `max_records` is given, nothing is done unless more than `max_records` records
+        are cached.
+        """
+        if max_records is not None and (self.records is None or
+                                        len(self.records) <= max_records):
+            return
+        if self.records is not None:
+            for key in [ k for k in self.records if k not in self.records_used ]:
+                del self.records[key]
+        self.records_used = set()
+
+
+# --------------------------------------------------
+
+class CrossrefResolver(object):
+    """
+    Merges into entries with a `crossref={...}` field the fields and persons which they
+    inherit from their parent entry, as BibTeX does.
+
+    `entries` is the mapping of citation keys to pybtex entries of the whole database
+    (e.g. `bibdata.entries`), which serves as the index of parent entries. Each parent is
+    resolved only once, even if it is itself a child of another entry; chains of
+    cross-references are followed and cycles are reported and broken.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self._resolved = {}
+
+    def resolve(self, entry):
+        """
+        Return a new entry with the inherited fields and persons merged in, without the
+        `crossref` field, or `entry` itself if it has no cross-reference to resolve.
+        """
+        if 'crossref' not in entry.fields:
+            return entry
+        return self._resolve(entry, [])
+
+    def _resolve(self, entry, chain):
+        lkey = entry.key.lower()
+        if lkey in self._resolved:
+            return self._resolved[lkey]
+
+        parentkey = entry.fields.get('crossref')
+        if not parentkey:
+            return entry
+
+        resolved = entry
+        if parentkey.lower() in chain or parentkey.lower() == lkey:
+            logger.warning("XML Export: Cyclic cross-references involving entry %s (%s)",
+                           entry.key, " -> ".join(chain + [lkey, parentkey.lower()]))
+        elif parentkey not in self.entries:
+            logger.warning("XML Export: Cross-referenced entry %s not found (in entry %s)",
+                           parentkey, entry.key)
+        else:
+            parent = self._resolve(self.entries[parentkey], chain + [lkey])
+            resolved = self._merge(entry, parent, self.entries[parentkey])
+
+        self._resolved[lkey] = resolved
+        return resolved
+
+    def _merge(self, entry, parent, unmerged_parent):
+        # `parent' is the resolved parent; `unmerged_parent' is the parent as it is in the
+        # database, without the fields it inherits itself.
+
+        # e.g. @proceedings parent of an @inproceedings without booktitle: the title of the
+        # direct parent (not a booktitle which the parent inherits from its own parent)
+        # becomes the booktitle. This takes precedence over an inherited series, see
+        # XML_FIELD_PRIORITY.
+        title_as_booktitle = ('booktitle' not in entry.fields
+                              and 'booktitle' not in unmerged_parent.fields
+                              and 'title' in unmerged_parent.fields)
+
+        fields = [ (k, v) for (k, v) in entry.fields.items() if k.lower() != 'crossref' ]
+        for (k, v) in parent.fields.items():
+            if k in entry.fields or k.lower() == 'crossref':
+                continue
+            if k.lower() == 'booktitle' and title_as_booktitle:
+                continue
+            fields.append((k, v))
+        if title_as_booktitle:
+            fields.append(('booktitle', unmerged_parent.fields['title']))
+
+        merged = Entry(entry.type, fields=fields)
+        merged.key = entry.key
+        for (role, persons) in entry.persons.items():
+            for person in persons:
+                merged.add_person(person, role)
+        for (role, persons) in parent.persons.items():
+            if role not in entry.persons:
+                for person in persons:
+                    merged.add_person(person, role)
+        return merged
+
+
+# --------------------------------------------------
+
+# number of records which are rendered together into a single chunk in pipelined mode
+PIPELINE_RECORDS_PER_CHUNK = 50
+
+class XmlChunkBuffer(object):
+    """
+    Minimal file-like object which collects what is written to it, in order to render
+    several records into a single chunk of text.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        self.chunks.append(s)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class XmlWriterThread(threading.Thread):
+    """
+    Background thread which writes chunks of text to the file object `fobj`, in the order
+    they are queued with `put()`.
+
+    At most `maxchunks` chunks are kept waiting in the queue; `put()` blocks if the
+    queue is full, which keeps memory bounded if rendering is faster than writing.
+    """
+    def __init__(self, fobj, maxchunks):
+        if maxchunks < 1:
+            # Queue.Queue() would not bound its size at all
+            raise ValueError("XmlWriterThread: maxchunks must be at least 1, got %r"
+                             %(maxchunks))
+        threading.Thread.__init__(self, name='bib2enxml-writer')
+        self.daemon = True
+        self.fobj = fobj
+        self.queue = Queue.Queue(maxsize=maxchunks)
+        self.error = None
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                # keep draining the queue so that put() never blocks forever
+                continue
+            try:
+                self.fobj.write(chunk)
+            except Exception as e:
+                self.error = e
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, chunk):
+        self.check_error()
+        self.queue.put(chunk)
+
+    def finish(self):
+        """
+        Wait for all queued chunks to be written and stop the thread.
+        """
+        self.queue.put(None)
+        self.join()
+
+
 # --------------------------------------------------
 
 ENT_BOOK = 6
@@ -76,6 +378,105 @@ ENTYPES = {
     }
 
 
+# When several bibtex fields map to the same XML field, the value of the field listed first
+# here is exported, whatever the order of the fields in the entry.
+XML_FIELD_PRIORITY = {
+    'secondary_title': ('journal', 'booktitle', 'school', 'series'),
+    'publisher': ('publisher', 'school'),
+    }
+
+
+def xml_style(val):
+    # remember that `val' must already be de-latex'ed and utf-8 encoded
+    return "<style face=\"normal\" font=\"normal\" size=\"100%\">" + val + "</style>"
+
+
+class EnXmlRecord(object):
+    """
+    The XML fields of a record which are collected from the bibtex fields, in a compact
+    form: there is one slot per XML tag, set to `None` if the tag is absent (and to an
+    empty string for an empty tag). Values must already be de-latex'ed and encoded for
+    XML.
+
+    `write()` writes the tags out in a fixed order, that of the EndNote XML DTD, so that
+    the same entry always gives the same bytes.
+    """
+
+    __slots__ = (
+        'title', 'secondary_title', 'pages', 'volume', 'number', 'edition', 'section',
+        'keywords', 'year', 'date', 'pub_location', 'publisher', 'isbn',
+        'electronic_resource_num', 'abstract', 'notes', 'work_type', 'remote_database_name',
+        'language', 'related_urls',
+        )
+
+    def __init__(self):
+        for slot in EnXmlRecord.__slots__:
+            setattr(self, slot, None)
+        # these are always written out, even if empty
+        self.notes = []
+        self.related_urls = []
+
+    def write(self, fobj):
+        write = fobj.write
+
+        def tag(name, val):
+            if val is None:
+                return
+            if not val:
+                write("<"+name+"/>")
+            else:
+                write("<"+name+">" + xml_style(val) + "</"+name+">")
+
+        def taglist(name, itemname, vals):
+            if not vals:
+                write("<"+name+"/>")
+                return
+            write("<"+name+">")
+            for val in vals:
+                tag(itemname, val)
+            write("</"+name+">")
+
+        if self.title is None and self.secondary_title is None:
+            write("<titles/>")
+        else:
+            write("<titles>")
+            tag('title', self.title)
+            tag('secondary-title', self.secondary_title)
+            write("</titles>")
+        tag('pages', self.pages)
+        tag('volume', self.volume)
+        tag('number', self.number)
+        tag('edition', self.edition)
+        tag('section', self.section)
+        if self.keywords is not None:
+            taglist('keywords', 'keyword', self.keywords)
+        write("<dates>")
+        tag('year', self.year)
+        if self.date is None:
+            write("<pub-dates/>")
+        else:
+            write("<pub-dates>")
+            tag('date', self.date)
+            write("</pub-dates>")
+        write("</dates>")
+        tag('pub-location', self.pub_location)
+        tag('publisher', self.publisher)
+        tag('isbn', self.isbn)
+        tag('electronic-resource-num', self.electronic_resource_num)
+        tag('abstract', self.abstract)
+        if not self.notes:
+            write("<notes/>")
+        else:
+            # notes are joined together into a single string with newlines
+            write("<notes>" + xml_style("\n".join(self.notes)) + "</notes>")
+        tag('work-type', self.work_type)
+        tag('remote-database-name', self.remote_database_name)
+        tag('language', self.language)
+        write("<urls>")
+        taglist('related-urls', 'url', self.related_urls)
+        write("</urls>")
+
+
 
 # --------------------------------------------------
 
@@ -102,7 +503,9 @@ class Bib2EnXmlFilter(BibFilter):
 
 
     def __init__(self, xmlfile="publications_%Y-%m-%dT%H-%M-%S.xml", export_annote=True,
-                 no_arxiv_urls=False, fixes_for_ethz=False, print_diff_to_last=False):
+                 no_arxiv_urls=False, fixes_for_ethz=False, print_diff_to_last=False,
+                 normalize_person_names=False, pipelined_write=False, write_queue_size=16,
+                 resolve_crossrefs=True, save_diff_index=False):
         """
         Bib2EnXmlFilter constructor.
 
@@ -110,7 +513,8 @@ class Bib2EnXmlFilter(BibFilter):
 
          - xmlfile: The name of the XML file to output to. This string will be parsed with
            `strftime()`, see [https://docs.python.org/2/library/time.html#time.strftime].
-           If the file exists, it will not be overwritten and an error will be reported.
+           If the file exists, it will not be overwritten and an error will be reported
+           (except in watch mode, see `bib2enxmlwatch', where it is replaced).
            The default value is 'publications_%Y-%m-%dT%H-%M-%S.xml'.
 
          - export_annote(bool): If set to `False`, then annote={} fields in the bibtex
@@ -127,6 +531,32 @@ class Bib2EnXmlFilter(BibFilter):
 
          - print_diff_to_last(bool): If `True`, then print out the difference between the
            new outputted XML file and the latest file generated with the same pattern.
+           Only the records which were added, removed or modified are shown. See also
+           `save_diff_index'.
+
+         - normalize_person_names(bool): If `True`, then author and editor names which
+           only differ by accents, braces, punctuation or case (e.g. `G{\\"o}del, K.' and
+           `Godel, K.') are considered to be the same person, and are all exported with
+           the spelling which appears first in the database.
+
+         - pipelined_write(bool): If `True`, then records are rendered in chunks which are
+           written to the XML file by a separate thread, so that rendering is not held up
+           by slow disk (e.g. network filesystem) writes.
+
+         - write_queue_size(int): In pipelined mode, the maximum number of rendered
+           chunks (of 50 records each) which may be waiting to be written to the file.
+           This bounds the memory used by the pipeline, and must be at least 1. The
+           default is 16.
+
+         - resolve_crossrefs(bool): If `True` (the default), then entries with a
+           `crossref={...}` field inherit the fields and authors/editors they don't
+           specify themselves from the cross-referenced entry, as in BibTeX. If `False`,
+           the `crossref` field is simply ignored.
+
+         - save_diff_index(bool): If `True`, then with `print_diff_to_last', an index of
+           the records is saved next to each XML file (with the extension `.recidx'), so
+           that the previous file need not be parsed again next time. This is off by
+           default, so that no other files than the XML files are written.
         """
 
         BibFilter.__init__(self);
@@ -137,6 +567,18 @@ class Bib2EnXmlFilter(BibFilter):
         self.no_arxiv_urls = getbool(no_arxiv_urls)
         self.fixes_for_ethz = getbool(fixes_for_ethz)
         self.print_diff_to_last = getbool(print_diff_to_last)
+        self.normalize_person_names = getbool(normalize_person_names)
+        self.pipelined_write = getbool(pipelined_write)
+        self.write_queue_size = int(write_queue_size)
+        if self.write_queue_size < 1:
+            raise BibFilterError(self.name(), "write_queue_size must be at least 1, got %d"
+                                 %(self.write_queue_size))
+        self.resolve_crossrefs = getbool(resolve_crossrefs)
+        self.save_diff_index = getbool(save_diff_index)
+
+        self.shared_render_cache = None
+        self.render_cache = RenderCache()
+        self.replace_existing_xmlfile = False
 
         logger.debug('bib2enxml: xmlfile=%r', self.xmlfile)
 
@@ -155,6 +597,42 @@ class Bib2EnXmlFilter(BibFilter):
             arxivutil.ArxivFetchedAPIInfoCacheAccessor
             ]
 
+    def use_render_cache(self, render_cache):
+        """
+        Use the given `RenderCache` for all subsequent runs instead of a fresh cache for
+        each run. Records are then only rendered again if the entry changed.
+        """
+        self.shared_render_cache = render_cache
+
+    def replace_xmlfile(self, replace=True):
+        """
+        If `replace` is `True`, then an existing XML file with the same name is replaced
+        instead of reporting an error. This is needed by long-running processes (see
+        `bib2enxmlwatch`) which export again to the same file name.
+        """
+        self.replace_existing_xmlfile = replace
+
+    def record_cache_key(self, entry, arxivinfo):
+        """
+        Return a key identifying everything that the rendered XML of `entry` depends on.
+        """
+        if self.normalize_person_names:
+            # the spelling variant which is written out depends on the other entries
+            person_key = self.render_cache.person_cache(True).get_xml
+        else:
+            person_key = unicode
+        return (
+            (self.export_annote, self.no_arxiv_urls, self.fixes_for_ethz,
+             self.normalize_person_names),
+            entry.key,
+            entry.type,
+            tuple(sorted( ( (k.lower(), unicode(v)) for (k, v) in entry.fields.items() ) )),
+            tuple(sorted( ( (role, tuple( (person_key(p) for p in persons) ))
+                            for (role, persons) in entry.persons.items() ) )),
+            ( (arxivinfo['arxivid'], arxivinfo['archiveprefix'], arxivinfo['published'])
+              if arxivinfo is not None else None ),
+            )
+
     def export_entry_xml(self, fobj, recnumber, entry, arxivaccess):
         """
         Writes the XML code representing a record ('<record>...</record>') for the given
@@ -173,20 +651,15 @@ class Bib2EnXmlFilter(BibFilter):
             obtained with `arxivutil.setup_and_get_arxiv_accessor()`.
         """
 
-        arxivinfo = arxivaccess.getArXivInfo(entry.key)
-        archiveprefix = ((arxivinfo['archiveprefix'] or "arxiv").lower() if arxivinfo else None)
+        self.write_entry_record(fobj, recnumber, entry, arxivaccess.getArXivInfo(entry.key))
 
-        logger.longdebug("Writing entry %s, arxivinfo=%r", entry.key, arxivinfo)
+    def write_entry_record(self, fobj, recnumber, entry, arxivinfo):
+        """
+        Same as `export_entry_xml()`, but with the arXiv information `arxivinfo` about the
+        entry given directly (or `None`) instead of being looked up in the arXiv cache.
+        """
 
-        # this will be where we collect the XML entries to set. Dictionary keys are XML
-        # tags. Can be recursive. Lists are joined together into a string with newlines.
-        xmlfields = {
-            'titles': { },
-            'urls': { 'related-urls': [] },
-            'notes': [],
-            'dates': { 'pub-dates': { } },
-            }
-        
+        logger.longdebug("Writing entry %s, arxivinfo=%r", entry.key, arxivinfo)
 
         # start the record.
         # -----------------
@@ -204,6 +677,47 @@ class Bib2EnXmlFilter(BibFilter):
                      ) % {'recnumber':recnumber}
                     )
 
+        records = self.render_cache.records
+        if records is None:
+            self.write_entry_xml_body(fobj, entry, arxivinfo)
+        else:
+            key = self.record_cache_key(entry, arxivinfo)
+            body = records.get(key)
+            if body is None:
+                buf = XmlChunkBuffer()
+                self.write_entry_xml_body(buf, entry, arxivinfo)
+                body = buf.getvalue()
+                records[key] = body
+            self.render_cache.records_used.add(key)
+            fobj.write(body)
+
+        fobj.write("</record>")
+
+        return
+
+    def write_entry_xml_body(self, fobj, entry, arxivinfo):
+        """
+        Writes the contents of the record for `entry` after its record number, i.e.,
+        everything from '<ref-type>' up to (but excluding) the closing '</record>'.
+
+        Arguments:
+
+          - `fobj`: a file-like object to write the XML to
+
+          - `entry` is a pybtex.database.Entry object.
+
+          - `arxivinfo` is the arXiv information about the entry, as returned by the
+            arXiv information cache, or `None`.
+        """
+
+        archiveprefix = ((arxivinfo['archiveprefix'] or "arxiv").lower() if arxivinfo else None)
+
+        delatex_for_xml = self.render_cache.delatex_for_xml
+        person_cache = self.render_cache.person_cache(self.normalize_person_names)
+
+        # this will be where we collect the XML fields to set.
+        xmlrec = EnXmlRecord()
+
         # now, set the entry type.
         # ------------------------
         
@@ -217,14 +731,14 @@ class Bib2EnXmlFilter(BibFilter):
             entype = ENT_CONFERENCE_PROCEEDINGS
         elif entry.type == 'phdthesis':
             entype = ENT_THESIS
-            xmlfields['work-type'] = "PhD Thesis"
+            xmlrec.work_type = "PhD Thesis"
         elif entry.type == 'book':
             entype = ENT_BOOK
         elif entry.type == 'inbook' or entry.type == 'incollection':
             entype = ENT_BOOK_SECTION
         elif entry.type == 'mastersthesis':
             entype = ENT_THESIS
-            xmlfields['work-type'] = "Master's Thesis"
+            xmlrec.work_type = "Master's Thesis"
         elif entry.type == 'misc':
             entype = ENT_GENERIC
         elif entry.type == 'unpublished':
@@ -241,13 +755,7 @@ class Bib2EnXmlFilter(BibFilter):
         # ----------------------------
         
         def writeperson(person):
-            fobj.write("<author>" +
-                         "<style face=\"normal\" font=\"default\" size=\"100%\">" +
-                           (
-                           delatex_for_xml(unicode(person))
-                           ) +
-                         "</style>" +
-                       "</author>")
+            fobj.write(person_cache.get_xml(person))
 
         fobj.write("<contributors>")
 
@@ -274,28 +782,40 @@ class Bib2EnXmlFilter(BibFilter):
         # and now, prepare the rest of the XML fields.
         # --------------------------------------------
 
-        for fldname, fldvalue in entry.fields.items():
+        # fields which are set from several bibtex fields, with the rank in
+        # XML_FIELD_PRIORITY of the bibtex field they were set from
+        prioritized_set_from = {}
+        def set_prioritized(xmlfldname, fldname, value):
+            rank = XML_FIELD_PRIORITY[xmlfldname].index(fldname)
+            if prioritized_set_from.get(xmlfldname, rank) < rank:
+                return
+            prioritized_set_from[xmlfldname] = rank
+            setattr(xmlrec, xmlfldname, value)
+
+        # go through the fields in a fixed order, so that the output (e.g. the order of the
+        # notes) does not depend on the order of the fields in the bibtex source
+        for fldname, fldvalue in sorted(entry.fields.items(), key=lambda kv: kv[0].lower()):
             
             fldname = fldname.lower()
             value = delatex_for_xml(fldvalue)
             
             if fldname == 'address':
-                xmlfields['pub-location'] = value
+                xmlrec.pub_location = value
             elif fldname == 'annote':
                 if self.export_annote:
-                    xmlfields['notes'].append(value)
+                    xmlrec.notes.append(value)
             elif fldname == 'booktitle':
-                xmlfields['titles']['secondary-title'] = value
+                set_prioritized('secondary_title', fldname, value)
             elif fldname == 'chapter':
-                xmlfields['section'] = value
+                xmlrec.section = value
             elif fldname == 'crossref':
                 logger.warning("XML Export: Ignoring cross-ref in entry %s!", entry.key)
                 continue
             elif fldname == 'edition':
-                xmlfields['edition'] = value
+                xmlrec.edition = value
             elif fldname == 'eprint':
                 if arxivinfo is None or archiveprefix != 'arxiv':
-                    xmlfields['notes'].append(value)
+                    xmlrec.notes.append(value)
                 # otherwise, we'll set up the arXiv information correctly anyway.
             elif fldname == 'journal':
                 if (self.fixes_for_ethz and arxivinfo and not arxivinfo['published']
@@ -303,42 +823,41 @@ class Bib2EnXmlFilter(BibFilter):
                     # unpublished, will be treated anyway automatically
                     pass
                 else:
-                    xmlfields['titles']['secondary-title'] = value
+                    set_prioritized('secondary_title', fldname, value)
             elif fldname == 'key':
                 logger.debug("Ignoring `key={%s}' field in %s for XML export", value, entry.key)
             elif fldname == 'language':
-                xmlfields['language'] = value
+                xmlrec.language = value
             elif fldname == 'month':
                 if not self.fixes_for_ethz:
-                    xmlfields['dates']['pub-dates'].setdefault('date','')
-                    xmlfields['dates']['pub-dates']['date'] += value
+                    xmlrec.date = (xmlrec.date or '') + value
             elif fldname == 'note':
-                xmlfields['notes'].append(value)
+                xmlrec.notes.append(value)
             elif fldname == 'number':
-                xmlfields['number'] = value
+                xmlrec.number = value
             elif fldname == 'pages':
-                xmlfields['pages'] = value
+                xmlrec.pages = value
             elif fldname == 'publisher':
-                xmlfields['publisher'] = value
+                set_prioritized('publisher', fldname, value)
             elif fldname == 'series':
-                xmlfields['titles']['secondary-title'] = value
+                set_prioritized('secondary_title', fldname, value)
             elif fldname == 'title':
-                xmlfields['titles']['title'] = value
+                xmlrec.title = value
             elif fldname == 'type':
-                xmlfields['work-type'] = value
+                xmlrec.work_type = value
             elif fldname == 'url':
                 for url in value.split():
                     logger.longdebug("Adding URL %s", url)
-                    xmlfields['urls']['related-urls'].append({'url': url})
+                    xmlrec.related_urls.append(url)
             elif fldname == 'volume':
-                xmlfields['volume'] = value
+                xmlrec.volume = value
             elif fldname == 'year':
-                xmlfields['dates']['year'] = value
+                xmlrec.year = value
             elif fldname == 'abstract':
-                xmlfields['abstract'] = value
+                xmlrec.abstract = value
             elif fldname == 'archiveprefix':
                 if not archiveprefix and value:
-                    xmlfields['notes'].append(value)
+                    xmlrec.notes.append(value)
             elif fldname == 'arxivid':
                 pass # skip, we have all we need in arxivinfo
             elif fldname == 'primaryclass':
@@ -347,26 +866,27 @@ class Bib2EnXmlFilter(BibFilter):
                 if self.fixes_for_ethz:
                     pass
                 else:
-                    xmlfields.setdefault('keywords', [])
+                    if xmlrec.keywords is None:
+                        xmlrec.keywords = []
                     for kw in re.split(r'[,;]+', fldvalue):
                         kwval = delatex_for_xml(kw.strip())
                         logger.longdebug("kw=%r, kwval=%r", kw, kwval)
-                        if kwval not in ( x['keyword'] for x in xmlfields['keywords'] ):
-                            xmlfields['keywords'].append({'keyword': kwval})
+                        if kwval not in xmlrec.keywords:
+                            xmlrec.keywords.append(kwval)
             elif fldname == 'doi':
                 if not self.fixes_for_ethz:
-                    xmlfields['electronic-resource-num'] = value
+                    xmlrec.electronic_resource_num = value
             elif fldname == 'issn' or fldname == 'isbn':
                 if not self.fixes_for_ethz:
-                    xmlfields['isbn'] = value
+                    xmlrec.isbn = value
             elif fldname == 'school':
                 if 'publisher' in entry.fields:
-                    xmlfields['titles']['secondary-title'] = value
+                    set_prioritized('secondary_title', fldname, value)
                 else:
-                    xmlfields['publisher'] = value
+                    set_prioritized('publisher', fldname, value)
             elif (fldname == 'howpublished' or fldname == 'institution' or
                   fldname == 'organization'):
-                xmlfields['notes'].append(value)
+                xmlrec.notes.append(value)
             elif (fldname == 'pmid' or fldname == 'shorttitle'):
                 pass # don't really care
             else:
@@ -383,50 +903,57 @@ class Bib2EnXmlFilter(BibFilter):
                                             entry.type in (u'phdthesis', u'mastersthesis',)):
                     pass
                 else:
-                    xmlfields['remote-database-name'] = "arXiv.org"
+                    xmlrec.remote_database_name = "arXiv.org"
                 if not self.no_arxiv_urls:
-                    xmlfields['urls']['related-urls'].append( {
-                        'url': "http://arxiv.org/abs/" + str(arxivinfo['arxivid'])
-                        } )
+                    xmlrec.related_urls.append("http://arxiv.org/abs/" + str(arxivinfo['arxivid']))
             else:
                 # it's another e-print, not too sure... the user must have provieded an
                 # URL or e-print which will be set in a URL or <notes>
-                xmlfields['remote-database-name'] = archiveprefix
+                xmlrec.remote_database_name = archiveprefix
 
         # Now, write those remaining XML fields and wrap up.
         # --------------------------------------------------
 
-        def write_xmlfields(val):
+        xmlrec.write(fobj)
 
-            if isinstance(val, dict):
-                for k,v in val.items():
-                    if not v:
-                        fobj.write("<"+k+"/>")
-                    else:
-                        fobj.write("<"+k+">")
-                        write_xmlfields(v)
-                        fobj.write("</"+k+">")
-                return
+        return
 
-            if isinstance(val, list):
-                if all( (isinstance(x,basestring) for x in val) ):
-                    write_xmlfields("\n".join(val))
-                else:
-                    for v in val:
-                        write_xmlfields(v)
-                return
-            
-            # remember that v was already de-latex'ed and utf-8 encoded
-            fobj.write("<style face=\"normal\" font=\"normal\" size=\"100%\">"
-                       + val + "</style>")
-            return
 
-        write_xmlfields(xmlfields)
-        
-        fobj.write("</record>")
-                
-        return
-        
+    def write_records(self, fobj, entries, arxivaccess):
+        """
+        Write the XML records for all the pybtex entries in the iterable `entries` to the
+        file-like object `fobj`, numbering them from 1.
+        """
+        recnumber = 1;
+        for entry in entries:
+            fobj.write("\n") #makes debugging easier, text editors hate very long lines...
+            # export & write this entry
+            self.export_entry_xml(fobj, recnumber, entry, arxivaccess)
+            recnumber += 1
+
+    def write_records_pipelined(self, fobj, entries, arxivaccess):
+        """
+        Same as `write_records()`, but records are rendered into chunks of
+        `PIPELINE_RECORDS_PER_CHUNK` records which are written to `fobj` by a
+        `XmlWriterThread` while the next chunks are being rendered.
+        """
+        writer = XmlWriterThread(fobj, maxchunks=self.write_queue_size)
+        writer.start()
+        try:
+            buf = XmlChunkBuffer()
+            recnumber = 1;
+            for entry in entries:
+                buf.write("\n")
+                self.export_entry_xml(buf, recnumber, entry, arxivaccess)
+                if recnumber % PIPELINE_RECORDS_PER_CHUNK == 0:
+                    writer.put(buf.getvalue())
+                    buf = XmlChunkBuffer()
+                recnumber += 1
+            writer.put(buf.getvalue())
+        finally:
+            writer.finish()
+        writer.check_error()
+
 
     def filter_bibolamazifile(self, bibolamazifile):
         #
@@ -437,24 +964,49 @@ class Bib2EnXmlFilter(BibFilter):
 
         arxivaccess = arxivutil.setup_and_get_arxiv_accessor(bibolamazifile)
 
-        if (os.path.exists(self.xmlfile)):
-            raise BibFilterError(self.name(), "File %s exists, won't overwrite." %(self.xmlfile));
+        # start each run with fresh caches, unless we were given caches to keep
+        if self.shared_render_cache is not None:
+            self.render_cache = self.shared_render_cache
+        else:
+            self.render_cache = RenderCache()
+        self.render_cache.begin_export()
 
         xmlfilepath = bibolamazifile.resolveSourcePath(self.xmlfile)
 
-        with open(xmlfilepath, 'w') as fobj:
+        if os.path.exists(xmlfilepath) and not self.replace_existing_xmlfile:
+            raise BibFilterError(self.name(), "File %s exists, won't overwrite." %(self.xmlfile));
 
-            fobj.write("<?xml version=\"1.0\" encoding=\"UTF-8\" ?>"
-                       "<xml><records>")
+        # write to a temporary file first, so that a complete XML file replaces the
+        # previous one at once
+        (xmldn, xmlbn) = os.path.split(xmlfilepath)
+        tmpxmlfilepath = os.path.join(xmldn, '.' + xmlbn + '.tmp')
 
-            recnumber = 1;
-            for key, entry in bibolamazifile.bibliographyData().entries.items():
-                fobj.write("\n") #makes debugging easier, text editors hate very long lines...
-                # export & write this entry
-                self.export_entry_xml(fobj, recnumber, entry, arxivaccess)
-                recnumber += 1
+        try:
+            with open(tmpxmlfilepath, 'w') as fobj:
+
+                fobj.write("<?xml version=\"1.0\" encoding=\"UTF-8\" ?>"
+                           "<xml><records>")
+
+                entries = bibolamazifile.bibliographyData().entries.values()
+                if self.resolve_crossrefs:
+                    resolver = CrossrefResolver(bibolamazifile.bibliographyData().entries)
+                    entries = ( resolver.resolve(entry) for entry in entries )
+                if self.pipelined_write:
+                    self.write_records_pipelined(fobj, entries, arxivaccess)
+                else:
+                    self.write_records(fobj, entries, arxivaccess)
+
+                fobj.write("</records></xml>");
+        except:
+            # don't leave an incomplete file behind
+            if os.path.exists(tmpxmlfilepath):
+                os.remove(tmpxmlfilepath)
+            raise
 
-            fobj.write("</records></xml>");
+        if os.name == 'nt' and os.path.exists(xmlfilepath):
+            # os.rename() doesn't replace existing files on Windows
+            os.remove(xmlfilepath)
+        os.rename(tmpxmlfilepath, xmlfilepath)
 
         if self.print_diff_to_last:
             # first, find the latest file which has our given pattern. Use strptime to
@@ -484,12 +1036,14 @@ class Bib2EnXmlFilter(BibFilter):
 
                 import diffendnoteex2xml
 
-                # now display diff
+                # now display diff. If we save the record indexes, the index of the file we
+                # just wrote is reused when it is the previous export, next time.
                 width = 100
-                difftext = diffendnoteex2xml.getFormattedDiffContents(
+                difftext = diffendnoteex2xml.getFormattedChangedContents(
                     os.path.join(dn,fn),
                     xmlfilepath,
                     txtwid=width,
+                    save_index=self.save_diff_index,
                     addindent=2,
                     )
                 logger.info("#"*width + "\n" +
@@ -0,0 +1,135 @@
+
+# Run many bibolamazi files (e.g. with bib2enxml exports) in a pool of worker processes.
+
+from __future__ import unicode_literals, print_function
+
+import sys
+import time
+import argparse
+import logging
+import traceback
+import multiprocessing
+
+import bib2enxml
+from bib2enxmlwatch import (run_bibolamazi_file, add_filterpackage_argument,
+                            setup_filterpackages_from_env)
+
+
+# --------------------------------------------------
+
+
+# by default, forget the records which weren't used recently once a worker has cached more
+# than this many records
+BATCH_MAX_RECORDS = 20000
+
+# the caches shared by all the bibolamazi files run in the current worker process
+_worker_render_cache = None
+_worker_max_records = None
+
+def _init_worker(cache_records, max_records):
+    global _worker_render_cache, _worker_max_records
+    _worker_render_cache = bib2enxml.RenderCache(cache_records=cache_records)
+    _worker_max_records = max_records
+
+def _run_one(fname):
+    """
+    Run the bibolamazi file `fname` in a worker process. Returns a tuple `(fname, time,
+    error)` where `error` is `None` or a string describing what went wrong.
+    """
+    t0 = time.time()
+    try:
+        run_bibolamazi_file(fname, _worker_render_cache)
+    except Exception as e:
+        return (fname, time.time() - t0, "%s: %s\n%s" %(e.__class__.__name__, e,
+                                                        traceback.format_exc()))
+    finally:
+        _worker_render_cache.prune_records(max_records=_worker_max_records)
+    return (fname, time.time() - t0, None)
+
+
+def run_batch(fnames, processes=None, cache_records=True, max_records=BATCH_MAX_RECORDS,
+              maxtasksperchild=None, callback=None):
+    """
+    Run all the bibolamazi files `fnames` across a pool of `processes` worker processes
+    (by default, as many as there are CPUs).
+
+    Within each worker, all the bib2enxml filters share the same `bib2enxml.RenderCache`,
+    so that people and (if `cache_records` is `True`) records which appear in several
+    databases are only rendered once per worker. Whenever a worker has more than
+    `max_records` records cached, it forgets those which were not used by any file since
+    the last time it did so. Use `maxtasksperchild` to replace workers, and thus drop
+    their caches, after that many files.
+
+    Normalized person names (see the `normalize_person_names` option of bib2enxml) are not
+    shared between databases: the spelling of each name only depends on the database
+    being exported, not on which other files the worker ran before.
+
+    If `callback` is given, it is called with the result of each file as it completes.
+    Returns a list of tuples `(fname, time, error)`, in the order of `fnames`, where
+    `error` is `None` if the file was run successfully.
+    """
+    pool = multiprocessing.Pool(processes=processes, initializer=_init_worker,
+                                initargs=(cache_records, max_records),
+                                maxtasksperchild=maxtasksperchild)
+    results = {}
+    try:
+        for res in pool.imap_unordered(_run_one, fnames):
+            results[res[0]] = res
+            if callback is not None:
+                callback(res)
+    finally:
+        pool.close()
+        pool.join()
+    return [ results[fn] for fn in fnames ]
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        prog='bib2enxmlbatch',
+        description='Run many bibolamazi files in parallel, sharing the bib2enxml caches '
+        'between the files handled by the same worker process',
+        )
+    parser.add_argument('-j', '--jobs', dest='jobs', action='store', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--no-record-cache', dest='cache_records', action='store_false',
+                        default=True,
+                        help='do not share rendered records between databases, only the '
+                        'de-LaTeX and person-name caches')
+    parser.add_argument('--max-cached-records', dest='max_records', action='store', type=int,
+                        default=BATCH_MAX_RECORDS,
+                        help='when a worker has cached more rendered records than this, forget '
+                        'those not used recently (default: %(default)d)')
+    parser.add_argument('--max-files-per-worker', dest='maxtasksperchild', action='store',
+                        type=int, default=None,
+                        help='restart each worker process (and empty its caches) after '
+                        'this many files, to bound memory usage')
+    add_filterpackage_argument(parser)
+    parser.add_argument('bibolamazifiles', nargs='+')
+
+    # set up the filter packages before the worker processes are forked, so that they
+    # inherit them
+    setup_filterpackages_from_env()
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    def report(res):
+        (fname, dt, error) = res
+        print("%8.2f s  %-6s  %s" %(dt, "FAILED" if error else "ok", fname))
+
+    t0 = time.time()
+    results = run_batch(args.bibolamazifiles, processes=args.jobs,
+                        cache_records=args.cache_records, max_records=args.max_records,
+                        maxtasksperchild=args.maxtasksperchild, callback=report)
+    failed = [ res for res in results if res[2] ]
+
+    print("\n%d files in %.2f s, %d failed." %(len(results), time.time() - t0, len(failed)))
+    for (fname, dt, error) in failed:
+        print("\n--- %s ---\n%s" %(fname, error))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
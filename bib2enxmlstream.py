@@ -0,0 +1,205 @@
+
+# Export huge .bib files to old EndNote XML with bounded memory, one entry at a time.
+
+from __future__ import unicode_literals, print_function
+
+import os
+import os.path
+import sys
+import codecs
+import argparse
+import logging
+
+from pybtex.database import BibliographyData
+from pybtex.database.input import bibtex
+
+try:
+    # bibolamazi v3
+    from bibolamazi.filters.util import arxivutil
+    logger = logging.getLogger(__name__)
+except ImportError:
+    # bibolamazi v2
+    from core.blogger import logger
+    from filters.util import arxivutil
+
+import bib2enxml
+
+
+# --------------------------------------------------
+
+
+def iter_bibtex_chunks(fobj):
+    """
+    Iterate over the top-level `@...{...}` (or `@...(...)`) commands of the bibtex file
+    `fobj`, reading it line by line. Yields the text of each command. Text outside of
+    commands is ignored, as it is by BibTeX.
+
+    A command ends at the brace (or parenthesis) matching its opening one, ignoring those
+    within braces or within a `"..."` string, e.g. in `@article(k, title = "A (b)")`.
+    """
+    chunk = []
+    state = None # None, 'head' (after '@') or 'body'
+    for line in fobj:
+        start = 0
+        for (i, c) in enumerate(line):
+            if state is None:
+                if c == '@':
+                    state = 'head'
+                    start = i
+                    head = []
+                continue
+            if state == 'head':
+                if c == '{' or c == '(':
+                    state = 'body'
+                    closer = ('}' if c == '{' else ')')
+                    # braces and parentheses nesting levels, not counting the command's
+                    # opening brace or parenthesis
+                    depth = 0
+                    pdepth = 0
+                    in_string = False
+                    # the contents of @comment aren't bibtex, don't look for strings there
+                    track_strings = ("".join(head).strip().lower() != 'comment')
+                else:
+                    head.append(c)
+                continue
+            # state == 'body'
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                if closer == '}' and depth == 0 and not in_string:
+                    chunk.append(line[start:i+1])
+                    yield "".join(chunk)
+                    chunk = []
+                    state = None
+                else:
+                    depth -= 1
+            elif depth > 0 or in_string and c != '"':
+                continue
+            elif c == '"':
+                if track_strings:
+                    in_string = not in_string
+            elif closer == ')' and c == '(':
+                pdepth += 1
+            elif closer == ')' and c == ')':
+                if pdepth == 0:
+                    chunk.append(line[start:i+1])
+                    yield "".join(chunk)
+                    chunk = []
+                    state = None
+                else:
+                    pdepth -= 1
+        if state is not None:
+            chunk.append(line[start:])
+    if state is not None:
+        logger.warning("bib2enxmlstream: ignoring incomplete bibtex command at end of file")
+
+
+def iter_bibtex_entries(fname, encoding='utf-8'):
+    """
+    Iterate over the entries of the bibtex file `fname`, parsing one entry at a time with
+    pybtex, so that only one entry is kept in memory. `@string` macros apply to the
+    entries which follow them, as usual.
+    """
+    parser = bibtex.Parser()
+    with codecs.open(fname, 'r', encoding=encoding) as fobj:
+        for chunk in iter_bibtex_chunks(fobj):
+            # only keep the macros from one chunk to the next, not the entries
+            parser.data = BibliographyData()
+            for entry in parser.parse_string(chunk).entries.values():
+                yield entry
+
+
+# number of rendered persons kept in memory: large libraries have many (often hundreds of
+# thousands) distinct authors
+STREAM_MAX_PERSONS = 10000
+
+def stream_export(bibfnames, xmlfile, encoding='utf-8', **kwargs):
+    """
+    Export the entries of the bibtex files `bibfnames` to the XML file `xmlfile`, one
+    entry at a time, keeping memory usage independent of the number of entries.
+
+    `xmlfile` and the other keyword arguments are the same as for `Bib2EnXmlFilter`. As
+    there is no bibolamazi arXiv cache here, arXiv information is detected directly from
+    the fields of each entry. Cross-references are not resolved, as that would require
+    keeping parent entries around. With `normalize_person_names`, one rendered name per
+    distinct person must be remembered, so that memory does grow with the number of
+    distinct people.
+
+    Returns the number of records written.
+    """
+    filtr = bib2enxml.Bib2EnXmlFilter(xmlfile=xmlfile, resolve_crossrefs=False, **kwargs)
+    filtr.render_cache = bib2enxml.RenderCache(max_persons=STREAM_MAX_PERSONS)
+
+    if os.path.exists(filtr.xmlfile):
+        raise ValueError("File %s exists, won't overwrite." %(filtr.xmlfile))
+
+    # write to a temporary file first, so that a failure doesn't leave a truncated XML
+    # file behind (which we would then refuse to overwrite)
+    (xmldn, xmlbn) = os.path.split(filtr.xmlfile)
+    tmpxmlfile = os.path.join(xmldn, '.' + xmlbn + '.tmp')
+
+    recnumber = 1
+    try:
+        with open(tmpxmlfile, 'w') as fobj:
+            fobj.write("<?xml version=\"1.0\" encoding=\"UTF-8\" ?>"
+                       "<xml><records>")
+            for bibfname in bibfnames:
+                for entry in iter_bibtex_entries(bibfname, encoding=encoding):
+                    fobj.write("\n")
+                    filtr.write_entry_record(fobj, recnumber, entry,
+                                             arxivutil.detectEntryArXivInfo(entry))
+                    recnumber += 1
+            fobj.write("</records></xml>")
+    except:
+        if os.path.exists(tmpxmlfile):
+            os.remove(tmpxmlfile)
+        raise
+
+    os.rename(tmpxmlfile, filtr.xmlfile)
+
+    return recnumber - 1
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        prog='bib2enxmlstream',
+        description='Export large bibtex files to old EndNote XML format one entry at a '
+        'time, with bounded memory',
+        )
+    parser.add_argument('-o', '--output', dest='xmlfile', action='store',
+                        default="publications_%Y-%m-%dT%H-%M-%S.xml",
+                        help='XML file to write (parsed with strftime())')
+    parser.add_argument('--encoding', dest='encoding', action='store', default='utf-8',
+                        help='encoding of the bibtex files')
+    parser.add_argument('--no-annote', dest='export_annote', action='store_false', default=True,
+                        help='do not export annote={} fields')
+    parser.add_argument('--no-arxiv-urls', dest='no_arxiv_urls', action='store_true',
+                        default=False, help='do not add arXiv URLs')
+    parser.add_argument('--fixes-for-ethz', dest='fixes_for_ethz', action='store_true',
+                        default=False, help='prepare for upload on ETHZ\'s publication database')
+    parser.add_argument('--normalize-person-names', dest='normalize_person_names',
+                        action='store_true', default=False,
+                        help='export spelling variants of the same name identically (keeps '
+                        'one name per distinct person in memory)')
+    parser.add_argument('bibfiles', nargs='+')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        n = stream_export(args.bibfiles, args.xmlfile, encoding=args.encoding,
+                          export_annote=args.export_annote,
+                          no_arxiv_urls=args.no_arxiv_urls,
+                          fixes_for_ethz=args.fixes_for_ethz,
+                          normalize_person_names=args.normalize_person_names)
+    except ValueError as e:
+        logger.error("bib2enxmlstream: %s", e)
+        return 1
+
+    logger.info("bib2enxmlstream: wrote %d records", n)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+
+# Keep re-running a bibolamazi file whenever its sources change, with warm bib2enxml caches.
+
+from __future__ import unicode_literals, print_function
+
+import os
+import os.path
+import sys
+import time
+import argparse
+import logging
+
+try:
+    # bibolamazi v3
+    from bibolamazi.core.bibolamazifile import BibolamaziFile
+    from bibolamazi.core.bibfilter import BibFilter
+    from bibolamazi.core.main import setup_filterpackages_from_env, AddFilterPackageAction
+    logger = logging.getLogger(__name__)
+except ImportError:
+    # bibolamazi v2
+    from core.bibolamazifile import BibolamaziFile
+    from core.bibfilter import BibFilter
+    from core.main import setup_filterpackages_from_env, AddFilterPackageAction
+    from core.blogger import logger
+
+import bib2enxml
+
+
+# --------------------------------------------------
+
+
+def add_filterpackage_argument(parser):
+    """
+    Add the `--filterpackage` option of the `bibolamazi` command to the argument parser
+    `parser`, so that the bib2enxml filter can be found. Call
+    `setup_filterpackages_from_env()` before parsing the arguments, so that the packages
+    given in the environment variable BIBOLAMAZI_FILTER_PATH are also used.
+    """
+    parser.add_argument('--filterpackage', '--filterpath', action=AddFilterPackageAction,
+                        help="add a package name in which to search for filters, as "
+                        "'package' or 'package=/some/location' (see bibolamazi --help); "
+                        "may be given several times. Packages in the environment variable "
+                        "BIBOLAMAZI_FILTER_PATH are also used")
+
+
+def run_filter(bfile, filtr):
+    """
+    Run the filter `filtr` on the `BibolamaziFile` `bfile`, as the `bibolamazi` command
+    does.
+    """
+    logger.info("Filter: %s", filtr.getRunningMessage())
+
+    if hasattr(filtr, 'prerun'):
+        filtr.prerun(bfile)
+
+    action = filtr.action()
+    if action == BibFilter.BIB_FILTER_BIBOLAMAZIFILE:
+        filtr.filter_bibolamazifile(bfile)
+    elif action == BibFilter.BIB_FILTER_SINGLE_ENTRY:
+        bibdata = bfile.bibliographyData()
+        for (k, entry) in bibdata.entries.iteritems():
+            filtr.filter_bibentry(entry)
+        bfile.setBibliographyData(bibdata)
+    else:
+        raise ValueError("Bad value for BibFilter.action(): %r" %(action))
+
+
+def run_bibolamazi_file(fname, render_cache, replace_xmlfile=False):
+    """
+    Run the bibolamazi file `fname`, as the `bibolamazi` command would, except that all
+    bib2enxml filters use the given `bib2enxml.RenderCache` instead of starting with
+    empty caches. If `replace_xmlfile` is `True`, the bib2enxml filters replace their
+    XML file if it already exists.
+
+    Returns the `BibolamaziFile` object.
+    """
+
+    bfile = BibolamaziFile(fname)
+
+    bibdata = bfile.bibliographyData()
+    if bibdata is None or not len(bibdata.entries):
+        raise ValueError("No source entries found in %s, not running it." %(fname))
+
+    for filtr in bfile.filters():
+        # filter modules may have been loaded under another module name than our own
+        # `bib2enxml', so don't rely on isinstance()
+        if hasattr(filtr, 'use_render_cache'):
+            filtr.use_render_cache(render_cache)
+            filtr.replace_xmlfile(replace_xmlfile)
+        run_filter(bfile, filtr)
+
+    bfile.saveToFile()
+
+    return bfile
+
+
+def get_watched_files(bfile, extra_files=[]):
+    """
+    Return the list of existing local files which `bfile` depends on: the bibolamazi file
+    itself, the bibtex sources which were read, as well as `extra_files`.
+    """
+    fnames = [ bfile.fname() ]
+    for src in bfile.sources():
+        if not src:
+            continue
+        fnames.append(bfile.resolveSourcePath(src))
+    fnames += extra_files
+    return [ os.path.abspath(fn) for fn in fnames if os.path.exists(fn) ]
+
+
+def get_mtimes(fnames):
+    mtimes = {}
+    for fn in fnames:
+        try:
+            mtimes[fn] = os.stat(fn).st_mtime
+        except OSError:
+            mtimes[fn] = None
+    return mtimes
+
+
+class Watcher(object):
+    """
+    Runs a bibolamazi file and runs it again each time one of the files it depends on is
+    modified.
+
+    All runs share the same `bib2enxml.RenderCache`, so that each run of the bib2enxml
+    filter only renders the records of entries which were added or modified since the
+    previous run. Modules (pylatexenc, bibolamazi, the filters) are also only loaded once.
+
+    The XML files are replaced on each run, so that a fixed output file name (or two runs
+    within the same second) works.
+    """
+    def __init__(self, fname, interval=1.0, extra_files=[]):
+        self.fname = fname
+        self.interval = interval
+        self.extra_files = extra_files
+        self.render_cache = bib2enxml.RenderCache(cache_records=True)
+        self.mtimes = {}
+
+    def run_once(self):
+        t0 = time.time()
+        try:
+            bfile = run_bibolamazi_file(self.fname, self.render_cache, replace_xmlfile=True)
+        except Exception as e:
+            logger.exception("bib2enxmlwatch: Error running %s: %s", self.fname, e)
+            # keep watching the files we knew about, and try again when they change
+            self.mtimes = get_mtimes(list(self.mtimes.keys()) or [self.fname])
+            return
+        # forget records of modified or removed entries
+        self.render_cache.prune_records()
+        # get the mtimes only now, as running the file rewrites the bibolamazi file itself
+        self.mtimes = get_mtimes(get_watched_files(bfile, self.extra_files))
+        logger.info("bib2enxmlwatch: ran %s in %.3f s, watching %d files",
+                    self.fname, time.time() - t0, len(self.mtimes))
+
+    def changed_files(self):
+        newmtimes = get_mtimes(list(self.mtimes.keys()))
+        return [ fn for fn in newmtimes if newmtimes[fn] != self.mtimes[fn] ]
+
+    def run(self):
+        self.run_once()
+        while True:
+            time.sleep(self.interval)
+            changed = self.changed_files()
+            if changed:
+                logger.info("bib2enxmlwatch: changed: %s", ", ".join(changed))
+                self.run_once()
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        prog='bib2enxmlwatch',
+        description='Run a bibolamazi file and run it again whenever its bibtex sources '
+        'change, keeping the bib2enxml caches warm between runs',
+        )
+    parser.add_argument('-i', '--interval', dest='interval', action='store', type=float,
+                        default=1.0, help='how often to check the files for changes (seconds)')
+    parser.add_argument('-f', '--watch-file', dest='extra_files', action='append', default=[],
+                        help='also run again when this file changes')
+    add_filterpackage_argument(parser)
+    parser.add_argument('bibolamazifile')
+
+    setup_filterpackages_from_env()
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    watcher = Watcher(args.bibolamazifile, interval=args.interval,
+                      extra_files=args.extra_files)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,19 @@
 
+import os
+import re
 import sys
+import mmap
+import json
 import argparse
 import textwrap
 import pydoc
 import copy
 import difflib
+import filecmp
+import itertools
 import locale
+import hashlib
+import collections
 import xml.etree.ElementTree as ET
 
 
@@ -97,6 +105,25 @@ def fmtelem(elem, **kwargs):
     return textcontent + "\n".join(txtlines)
 
 
+def canonelem(elem, skip=[]):
+    """
+    Return a canonical unicode string representing the element `elem`, suitable for
+    comparing records without formatting them. Like `fmtelem()`, the relative order of
+    child elements with different tags is ignored, and child elements whose tag is in
+    `skip` are left out.
+    """
+    s = u'<' + elem.tag
+    for (k, v) in sorted(elem.items()):
+        s += u' ' + k + u'="' + v + u'"'
+    s += u'>'
+    if elem.text:
+        s += elem.text.strip()
+    # sorted() is stable, so repeated tags (e.g. authors) keep their order
+    for e in sorted((e for e in elem if e.tag not in skip), key=lambda e: e.tag):
+        s += canonelem(e, skip)
+    return s + u'</' + elem.tag + u'>'
+
+
 class ParsedXMLEndNoteX2:
     def __init__(self, fname):
         self.tree = ET.parse(fname)
@@ -120,6 +147,21 @@ class ParsedXMLEndNoteX2:
 
         def fmt(self, **kwargs):
             return fmtelem(self.elem, **kwargs)
+
+        def identity(self):
+            """
+            Return the normalized title (see `normalize_title()`), which identifies the
+            record across different exports, even if its other fields changed. (E.g., the
+            reference type and the year of an arXiv preprint change when it is published.)
+            """
+            return normalize_title(contentof(self.elem.find('titles/title')))
+
+        def digest(self):
+            """
+            Return a hash of the record contents, ignoring the same bookkeeping elements as
+            the formatted output.
+            """
+            return hashlib.sha1(canonelem(self.elem, RECORD_SKIP_TAGS).encode('utf-8')).hexdigest()
         
 #             reftype = attrof(self.elem.find('ref-type'), 'name', default='<unknown>')
 #             txt = u"[" + reftype + "] "
@@ -162,6 +204,285 @@ class ParsedXMLEndNoteX2:
 #             wrapper = textwrap.TextWrapper(width=txtwid)
 
 
+# -----------------------------------------------------------------------
+
+RECORD_SKIP_TAGS = ['database', 'source-app', 'foreign-keys', 'rec-number']
+
+
+def normalize_title(title):
+    """
+    Normalize a record title for matching records across exports: lower case, with
+    punctuation removed and whitespace collapsed.
+    """
+    return u" ".join(re.split(r'\W+', unicode(title).lower(), flags=re.UNICODE)).strip()
+
+
+def iter_records(fname):
+    """
+    Iterate over the records of the XML file `fname` without building the whole tree in
+    memory. Yields `ParsedXMLEndNoteX2.Record` objects, which are only valid until the
+    next record is read.
+    """
+    for event, elem in ET.iterparse(fname, events=('end',)):
+        if elem.tag != 'record':
+            continue
+        yield ParsedXMLEndNoteX2.Record(elem)
+        elem.clear()
+
+
+def iter_record_digests(fname):
+    """
+    Iterate over the records of the XML file `fname`, yielding pairs `(key, digest)` (see
+    `ParsedXMLEndNoteX2.Record.digest()`).
+
+    A record key is a tuple `(identity, n)`, where `identity` is given by
+    `ParsedXMLEndNoteX2.Record.identity()` and `n` counts the previous records with the
+    same identity in the file.
+    """
+    identitycount = {}
+    for rec in iter_records(fname):
+        identity = rec.identity()
+        n = identitycount.get(identity, 0)
+        identitycount[identity] = n + 1
+        yield ((identity, n), rec.digest())
+
+
+def getRecordDigests(fname):
+    """
+    Parse the XML file `fname` once and return an ordered dictionary mapping record keys
+    to record digests (see `iter_record_digests()`).
+    """
+    return collections.OrderedDict(iter_record_digests(fname))
+
+
+def fmtrecordkey(key):
+    (title, n) = key
+    s = u"\"%s\"" %(title)
+    if n:
+        s += u" #%d" %(n+1)
+    return s
+
+
+def getRecordHistory(fnames):
+    """
+    Compute the change history of each record across the XML snapshots `fnames`, given
+    in chronological order. Each file is parsed only once.
+
+    Returns an ordered dictionary mapping record keys (see `getRecordDigests()`) to lists
+    of events `(index, what)`, where `index` is the index of the snapshot in `fnames` and
+    `what` is one of 'initial', 'added', 'modified' or 'removed'.
+    """
+    history = collections.OrderedDict()
+    prev = None
+    for (index, fname) in enumerate(fnames):
+        cur = getRecordDigests(fname)
+        for (key, digest) in cur.items():
+            if prev is None:
+                what = 'initial'
+            elif key not in prev:
+                what = 'added'
+            elif prev[key] != digest:
+                what = 'modified'
+            else:
+                continue
+            history.setdefault(key, []).append((index, what))
+        if prev is not None:
+            for key in prev:
+                if key not in cur:
+                    history.setdefault(key, []).append((index, 'removed'))
+        prev = cur
+    return history
+
+
+def getFormattedHistoryContents(fnames, addindent=4, **kwargs):
+    """
+    Return a text report of the changes of each record across the XML snapshots `fnames`,
+    given in chronological order. Records which never changed after the first snapshot
+    are not listed.
+    """
+    history = getRecordHistory(fnames)
+
+    blocks = []
+    for (key, events) in history.items():
+        if len(events) == 1 and events[0][1] == 'initial':
+            continue
+        lines = [ fmtrecordkey(key) ]
+        for (index, what) in events:
+            lines.append(u" "*addindent + u"%s: %s" %(fnames[index], what))
+        blocks.append(u"\n".join(lines))
+
+    return u"\n\n".join(blocks) + u"\n"
+
+
+RECORD_RX = re.compile(r'<record\b[^>]*>.*?</record>', flags=re.DOTALL)
+
+class RecordIndex:
+    """
+    Index of the records of an XML export: the byte offset, length, key (see
+    `iter_record_digests()`) and digest of each `<record>`. The file is memory-mapped, and
+    individual records are only parsed when they are requested with `getRecord()`.
+
+    Building the index parses each record once. If `use_saved` is `True`, then the index
+    is saved to a file next to the XML file (see `indexfname()`), and reused as long as the
+    XML file is not modified. If the index can't be saved, it is simply not saved.
+    """
+    def __init__(self, fname, use_saved=False):
+        self.fname = fname
+        self.fobj = open(fname, 'rb')
+        st = os.fstat(self.fobj.fileno())
+        self.stamp = [st.st_size, st.st_mtime]
+        if st.st_size:
+            self.mm = mmap.mmap(self.fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # empty files can't be memory-mapped; they have no records anyway
+            self.mm = None
+
+        # list of (offset, length, key, digest)
+        self.entries = None
+        if use_saved:
+            self._load()
+        if self.entries is None:
+            self._build()
+            if use_saved:
+                self._save()
+
+        self.bykey = dict( ( (e[2], n) for (n, e) in enumerate(self.entries) ) )
+
+    @staticmethod
+    def indexfname(fname):
+        return fname + '.recidx'
+
+    def _build(self):
+        self.entries = []
+        if self.mm is None:
+            return
+        identitycount = {}
+        for m in RECORD_RX.finditer(self.mm):
+            rec = ParsedXMLEndNoteX2.Record(ET.fromstring(m.group()))
+            identity = rec.identity()
+            n = identitycount.get(identity, 0)
+            identitycount[identity] = n + 1
+            self.entries.append( (m.start(), m.end() - m.start(), (identity, n), rec.digest()) )
+
+    # changes whenever the format of the saved indexes (e.g. of the record keys) changes
+    INDEX_VERSION = 2
+
+    def _load(self):
+        try:
+            with open(RecordIndex.indexfname(self.fname)) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('version') != RecordIndex.INDEX_VERSION or data.get('stamp') != self.stamp:
+            # XML file was modified since the index was saved, or old index format
+            return
+        self.entries = [ (off, length, (identity, n), digest)
+                         for (off, length, (identity, n), digest) in data['records'] ]
+
+    def _save(self):
+        indexfname = RecordIndex.indexfname(self.fname)
+        try:
+            with open(indexfname, 'w') as f:
+                json.dump({'version': RecordIndex.INDEX_VERSION, 'stamp': self.stamp,
+                           'records': self.entries}, f)
+        except (IOError, OSError):
+            # the index is only an optimization, e.g. the directory may be read-only
+            try:
+                os.remove(indexfname)
+            except OSError:
+                pass
+
+    def keys(self):
+        return [ e[2] for e in self.entries ]
+
+    def has_key(self, key):
+        return key in self.bykey
+
+    def digest(self, key):
+        return self.entries[self.bykey[key]][3]
+
+    def getRecord(self, key):
+        (off, length, key, digest) = self.entries[self.bykey[key]]
+        return ParsedXMLEndNoteX2.Record(ET.fromstring(self.mm[off:off+length]))
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.fobj.close()
+
+
+class DiffSummary:
+    """
+    Which records were added, removed or modified between two XML files. Each attribute
+    is a list of record keys (see `iter_record_digests()`).
+    """
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.modified = []
+
+    def has_differences(self):
+        return bool(self.added or self.removed or self.modified)
+
+    def fmt(self):
+        lines = [ u"added: %d, removed: %d, modified: %d" %(len(self.added), len(self.removed),
+                                                            len(self.modified)) ]
+        for (sym, keys) in ((u'+', self.added), (u'-', self.removed), (u'~', self.modified)):
+            for key in keys:
+                lines.append(sym + u" " + fmtrecordkey(key))
+        return u"\n".join(lines) + u"\n"
+
+
+def getDiffSummary(afname, bfname, stop_at_first=False):
+    """
+    Compare the records of the XML files `afname` and `bfname` by their digests, without
+    formatting them, and return a `DiffSummary`. The order of the records is ignored.
+
+    If the files are byte-identical, they are not parsed at all. If `stop_at_first` is
+    `True`, then both files are read in parallel and the comparison stops as soon as a
+    difference is found; the returned summary then only contains that difference.
+    """
+    summary = DiffSummary()
+
+    if filecmp.cmp(afname, bfname, shallow=False):
+        return summary
+
+    if not stop_at_first:
+        adigests = getRecordDigests(afname)
+        bdigests = getRecordDigests(bfname)
+        for (key, digest) in bdigests.items():
+            if key not in adigests:
+                summary.added.append(key)
+            elif adigests[key] != digest:
+                summary.modified.append(key)
+        summary.removed = [ key for key in adigests if key not in bdigests ]
+        return summary
+
+    # records seen in one file, whose counterpart in the other file wasn't seen yet
+    apending = {}
+    bpending = {}
+    for (apair, bpair) in itertools.izip_longest(iter_record_digests(afname),
+                                                 iter_record_digests(bfname)):
+        if apair == bpair:
+            continue
+        for (pair, mypending, otherpending) in ((apair, apending, bpending),
+                                                (bpair, bpending, apending)):
+            if pair is None:
+                continue
+            (key, digest) = pair
+            if key not in otherpending:
+                mypending[key] = digest
+            elif otherpending.pop(key) != digest:
+                summary.modified.append(key)
+                return summary
+
+    # whatever is left unmatched was added or removed
+    summary.removed = list(apending.keys())[:1]
+    if not summary.removed:
+        summary.added = list(bpending.keys())[:1]
+    return summary
+
+
 # -----------------------------------------------------------------------
 
 
@@ -234,6 +555,28 @@ def getFormattedFileContents(fname, LISTSEP=None, sortedentries=False, **kwargs)
     return LISTSEP.join(items)
 
 
+def getcompareitemlines(left, right, leftwid, rightwid):
+    """
+    ...
+    note: `left` and `right` MUST be wrapped to their respective widths.
+    """
+    s = ''
+    leftlines = left.split('\n')
+    rightlines = right.split('\n')
+    for n in range(max(len(leftlines), len(rightlines))):
+        if n < len(leftlines):
+            leftline = leftlines[n]
+            s += leftline + (' '*(leftwid-len(leftline)))
+        else:
+            s += ' '*leftwid
+
+        if n < len(rightlines):
+            s += rightlines[n]
+
+        s += '\n'
+    return s
+
+
 def getFormattedDiffContents(afname, bfname, RECSEP=None, sortedentries=True, txtwid=None, **kwargs):
     #
     # display DIFF of two XML files
@@ -273,27 +616,6 @@ def getFormattedDiffContents(afname, bfname, RECSEP=None, sortedentries=True, tx
 
     data = ''
 
-    def getcompareitemlines(left, right, leftwid, rightwid):
-        """
-        ...
-        note: `left` and `right` MUST be wrapped to their respective widths.
-        """
-        s = ''
-        leftlines = left.split('\n')
-        rightlines = right.split('\n')
-        for n in range(max(len(leftlines), len(rightlines))):
-            if n < len(leftlines):
-                leftline = leftlines[n]
-                s += leftline + (' '*(leftwid-len(leftline)))
-            else:
-                s += ' '*leftwid
-
-            if n < len(rightlines):
-                s += rightlines[n]
-
-            s += '\n'
-        return s
-
     if not RECSEP:
         RECSEP = '\n' + '-'*(txtwid*2) + '\n\n'
 
@@ -310,12 +632,81 @@ def getFormattedDiffContents(afname, bfname, RECSEP=None, sortedentries=True, tx
         data += RECSEP
 
     return data
+
+
+def getFormattedChangedContents(afname, bfname, RECSEP=None, txtwid=None, save_index=False,
+                                **kwargs):
+    #
+    # display DIFF of two XML files, formatting only the records which changed
+    #
+    # Unlike getFormattedDiffContents(), records are matched by their identity (see
+    # ParsedXMLEndNoteX2.Record.identity()) and only added, removed and modified records
+    # are parsed and formatted, using a RecordIndex of each file. With save_index=True, the
+    # indexes are saved next to the XML files and reused next time.
+    #
+
+    fmtkwargs = {
+        'skip': RECORD_SKIP_TAGS,
+        'flattenlevels': ['style']
+        }
+    if txtwid is None:
+        try:
+            (termwid, termhgt) = getTerminalSize()
+        except Exception as e:
+            termwid = 80
+    else:
+        termwid = txtwid
+
+    txtwidwrap = int(termwid*0.45)
+    txtwid = int(termwid*0.5)
+
+    fmtkwargs.update(kwargs)
+    fmtkwargs['txtwid'] = txtwidwrap
+
+    if not RECSEP:
+        RECSEP = '\n' + '-'*(txtwid*2) + '\n\n'
+
+    if filecmp.cmp(afname, bfname, shallow=False):
+        return ''
+
+    aindex = RecordIndex(afname, use_saved=save_index)
+    bindex = RecordIndex(bfname, use_saved=save_index)
+
+    data = ''
+    try:
+        for key in bindex.keys():
+            if not aindex.has_key(key):
+                data += getcompareitemlines('', bindex.getRecord(key).fmt(**fmtkwargs),
+                                            txtwid, txtwid)
+            elif aindex.digest(key) != bindex.digest(key):
+                data += getcompareitemlines(aindex.getRecord(key).fmt(**fmtkwargs),
+                                            bindex.getRecord(key).fmt(**fmtkwargs),
+                                            txtwid, txtwid)
+            else:
+                continue
+            data += RECSEP
+        for key in aindex.keys():
+            if not bindex.has_key(key):
+                data += getcompareitemlines(aindex.getRecord(key).fmt(**fmtkwargs), '',
+                                            txtwid, txtwid)
+                data += RECSEP
+    finally:
+        aindex.close()
+        bindex.close()
+
+    return data
     
 
 
 # ----------------------------------------------------------------------
 
 
+def encode_for_output(u):
+    # characters which the terminal's encoding can't represent (e.g. with LANG=C) are
+    # replaced by '?' rather than raising an error
+    return u.encode(locale.getpreferredencoding() or 'utf-8', 'replace')
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
@@ -332,28 +723,82 @@ if __name__ == '__main__':
                         help='display terminal width')
     parser.add_argument('-i', '--indent', dest='indent', action='store', type=int, default=None,
                         help='how much to indent lines')
+    parser.add_argument('-H', '--history', dest='history', action='store_true', default=False,
+                        help='show when each record changed across all the given files, '
+                        'in the order given (e.g. all archived exports)')
+    parser.add_argument('--summary', dest='summary', action='store_true', default=False,
+                        help='only print how many and which records were added, removed or '
+                        'modified; as with diff, the exit status is 0 if the files are the same, '
+                        '1 if they differ and 2 if an error occurred')
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', default=False,
+                        help='print nothing, stop at the first difference and only report it '
+                        'with the exit status (implies --summary)')
+    parser.add_argument('-c', '--changed-only', dest='changed_only', action='store_true',
+                        default=False,
+                        help='match records by identity and only parse and format those which '
+                        'changed (faster on large files)')
+    parser.add_argument('--save-index', dest='save_index', action='store_true', default=False,
+                        help='with --changed-only, save record indexes next to the XML files '
+                        'and reuse them in later runs')
     parser.add_argument('afile')
-    parser.add_argument('bfile', nargs='?')
+    parser.add_argument('bfiles', nargs='*', metavar='bfile')
 
     args = parser.parse_args()
 
+    if len(args.bfiles) > 1 and not args.history:
+        parser.error("more than two files given, did you mean --history?")
+    if (args.summary or args.quiet) and len(args.bfiles) != 1:
+        parser.error("--summary and --quiet need exactly two files")
+
     fnkwargs = {}
     if args.width is not None:
         fnkwargs['txtwid'] = args.width
     if args.indent is not None:
         fnkwargs['addindent'] = args.indent
 
-    if not args.bfile:
+    if args.summary or args.quiet:
+
+        # don't let errors look like differences (exit status 1) to scripts
+        try:
+            summary = getDiffSummary(args.afile, args.bfiles[0], stop_at_first=args.quiet)
+            if not args.quiet:
+                sys.stdout.write(encode_for_output(summary.fmt()))
+                sys.stdout.flush()
+        except (IOError, OSError, ET.ParseError) as e:
+            sys.stderr.write("diffendnotex2xml: %s\n" %(e))
+            sys.exit(2)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            sys.stderr.write("diffendnotex2xml: unexpected error: %s\n" %(e))
+            sys.exit(2)
+
+        sys.exit(1 if summary.has_differences() else 0)
+
+    elif args.history:
+
+        contents = getFormattedHistoryContents([args.afile] + args.bfiles, **fnkwargs)
+
+        pydoc.pager(encode_for_output(contents))
+
+    elif not args.bfiles:
         # just display afile entries
 
         contents = getFormattedFileContents(args.afile, sortedentries=args.sorted,
                                             **fnkwargs)
 
-        pydoc.pager(contents.encode(locale.getpreferredencoding()))
+        pydoc.pager(encode_for_output(contents))
+
+    elif args.changed_only:
+
+        contents = getFormattedChangedContents(args.afile, args.bfiles[0],
+                                               save_index=args.save_index, **fnkwargs)
+
+        pydoc.pager(encode_for_output(contents))
 
     else:
 
-        contents = getFormattedDiffContents(args.afile, args.bfile, sortedentries=args.sorted,
+        contents = getFormattedDiffContents(args.afile, args.bfiles[0], sortedentries=args.sorted,
                                             **fnkwargs)
 
-        pydoc.pager(contents.encode(locale.getpreferredencoding()))
+        pydoc.pager(encode_for_output(contents))
@@ -0,0 +1,404 @@
+
+# Memory profiling harness for the bib2enxml export and for diffendnoteex2xml.
+
+from __future__ import unicode_literals, print_function
+
+import os
+import os.path
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import resource
+import threading
+import gc
+import collections
+import multiprocessing
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 without the pytracemalloc backport: fall back to peak RSS and to counts of
+    # objects by type (see count_objects())
+    tracemalloc = None
+
+from pybtex.database import BibliographyData, Entry, Person
+
+import bib2enxml
+import bib2enxmlstream
+import diffendnoteex2xml
+
+
+# --------------------------------------------------
+
+class NoArxivInfo(object):
+    """
+    Stands in for the arXiv cache accessor when exporting outside of a bibolamazi run: no
+    entry has any arXiv information.
+    """
+    def getArXivInfo(self, entrykey):
+        return None
+
+
+NUM_PERSONS = 300
+# the number of distinct people grows with the size of real libraries
+PERSONS_PER_ENTRY = 2
+
+def synthetic_entries(num, modified_every=0):
+    """
+    Return `num` synthetic pybtex entries, with authors drawn from a pool of
+    `NUM_PERSONS + PERSONS_PER_ENTRY*num` people. If `modified_every` is nonzero, then the
+    title of every `modified_every`-th entry is changed (for producing a second, slightly
+    different, export).
+    """
+    numpersons = NUM_PERSONS + PERSONS_PER_ENTRY*num
+    persons = [ "Author{}, First{} M.".format(i, i) for i in range(numpersons) ]
+    entries = []
+    for n in range(num):
+        title = "A {\\em synthetic} title about $\\alpha$-things, number %d" %(n)
+        if modified_every and n % modified_every == 0:
+            title += ", revised"
+        entry = Entry('article', fields={
+            'title': title,
+            'journal': "Journal of Synthetic Results",
+            'year': "%d" %(1990 + n % 30),
+            'volume': "%d" %(n % 100),
+            'pages': "%d--%d" %(n, n+10),
+            'doi': "10.1000/synthetic.%d" %(n),
+            'note': "Some note with accents: G{\\\"o}del, Schr{\\\"o}dinger",
+            })
+        entry.key = "synthetic%d" %(n)
+        for k in range(5 + n % 46):
+            entry.add_person(Person(persons[(7*n + k) % numpersons]), 'author')
+        entries.append(entry)
+    return entries
+
+def write_synthetic_bibfile(num, bibfname):
+    from pybtex.database.output import bibtex
+    bibdata = BibliographyData()
+    for entry in synthetic_entries(num):
+        bibdata.add_entry(entry.key, entry)
+    bibtex.Writer().write_file(bibdata, bibfname)
+
+def read_bibfile(bibfile):
+    from pybtex.database.input import bibtex
+    return list(bibtex.Parser().parse_file(bibfile).entries.values())
+
+
+def export_entries(entries, xmlfname):
+    filtr = bib2enxml.Bib2EnXmlFilter(xmlfile=xmlfname)
+    with open(xmlfname, 'w') as fobj:
+        fobj.write("<?xml version=\"1.0\" encoding=\"UTF-8\" ?>"
+                   "<xml><records>")
+        filtr.write_records(fobj, entries, NoArxivInfo())
+        fobj.write("</records></xml>")
+
+
+# --------------------------------------------------
+
+def current_rss():
+    """
+    Return the current resident set size of this process in bytes, or `None` if it can't
+    be determined (only supported on linux).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def count_objects():
+    """
+    Return a `collections.Counter` of the objects tracked by the garbage collector, by
+    type name. Only containers and instances are tracked, not strings or numbers.
+    """
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return counts
+
+
+class RssSampler(threading.Thread):
+    """
+    Samples the current RSS every `interval` seconds in the background, to find the peak
+    RSS reached while some code runs. Unlike `ru_maxrss`, this is not hidden by a
+    high-water mark reached before the measurement started.
+
+    If `census` is `True`, then objects are also counted by type (see `count_objects()`)
+    whenever a new peak RSS is reached, at most every `census_interval` seconds. `census`
+    is then the count taken at the highest RSS.
+    """
+    def __init__(self, interval=0.01, census=False, census_interval=0.5):
+        threading.Thread.__init__(self, name='memprofile-rss-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.peak = current_rss()
+        self.take_census = census
+        self.census_interval = census_interval
+        self.census = None
+        self._census_rss = self.peak
+        self._census_time = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = current_rss()
+            self.peak = max(self.peak, rss)
+            if (self.take_census and rss > self._census_rss and
+                time.time() - self._census_time >= self.census_interval):
+                self.census = count_objects()
+                self._census_rss = rss
+                self._census_time = time.time()
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+def _measure(fn, numrecords, numtop):
+    """
+    Run `fn()` and return a dictionary with timing and memory information. Must be run in
+    a fresh process (see `run_in_child()`) for the peak RSS to be meaningful.
+
+    Without tracemalloc (python 2), the allocation counts and top allocation sites are
+    replaced by the increase in the number of objects of each type, counted near the peak
+    RSS (see `RssSampler`).
+    """
+    census_before = None
+    if tracemalloc is None:
+        gc.collect()
+        census_before = count_objects()
+    rss_before = current_rss()
+    maxrss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sampler = None
+    if rss_before is not None:
+        sampler = RssSampler(census=(tracemalloc is None))
+        sampler.start()
+    if tracemalloc is not None:
+        tracemalloc.start(10)
+
+    t0 = time.time()
+    fn()
+    dt = time.time() - t0
+
+    if sampler is not None:
+        peak_rss = sampler.stop() - rss_before
+    else:
+        # ru_maxrss is in kilobytes on linux
+        peak_rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss_before) * 1024
+
+    res = {
+        'records': numrecords,
+        'time': dt,
+        'peak_rss': peak_rss,
+        'peak': None,
+        'blocks': None,
+        'blocks_unit': 'blocks',
+        'top': [],
+        }
+    if tracemalloc is None:
+        census = sampler.census if sampler is not None else None
+        if census is None:
+            # memory never grew while sampling: count what is left
+            census = count_objects()
+        census.subtract(census_before)
+        res['blocks'] = sum(census.values())
+        res['blocks_unit'] = 'objects'
+        res['top'] = [ "%10d objects  %s" %(count, typename)
+                       for (typename, count) in census.most_common(numtop) ]
+    else:
+        snapshot = tracemalloc.take_snapshot()
+        res['peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stats = snapshot.statistics('lineno')
+        res['blocks'] = sum( (s.count for s in stats) )
+        res['top'] = [ "%10d B %8d blocks  %s" %(s.size, s.count, s.traceback)
+                       for s in stats[:numtop] ]
+    return res
+
+def profile_export(entries_spec, tmpdir, numtop):
+    entries = (synthetic_entries(entries_spec) if isinstance(entries_spec, int)
+               else read_bibfile(entries_spec))
+    xmlfname = os.path.join(tmpdir, 'export.xml')
+    return _measure(lambda: export_entries(entries, xmlfname), len(entries), numtop)
+
+def profile_diff(entries_spec, tmpdir, numtop):
+    if isinstance(entries_spec, int):
+        aentries = synthetic_entries(entries_spec)
+        bentries = synthetic_entries(entries_spec, modified_every=20)
+    else:
+        aentries = bentries = read_bibfile(entries_spec)
+    afname = os.path.join(tmpdir, 'a.xml')
+    bfname = os.path.join(tmpdir, 'b.xml')
+    export_entries(aentries, afname)
+    export_entries(bentries, bfname)
+    numrecords = len(bentries)
+    del aentries, bentries
+    return _measure(lambda: diffendnoteex2xml.getFormattedDiffContents(afname, bfname,
+                                                                       txtwid=100),
+                    numrecords, numtop)
+
+def _get_bibfile(entries_spec, tmpdir):
+    if not isinstance(entries_spec, int):
+        return entries_spec
+    bibfname = os.path.join(tmpdir, 'synthetic.bib')
+    write_synthetic_bibfile(entries_spec, bibfname)
+    return bibfname
+
+def _count_entries(bibfname):
+    return sum( (1 for e in bib2enxmlstream.iter_bibtex_entries(bibfname)) )
+
+def profile_bibexport(entries_spec, tmpdir, numtop):
+    # the regular path: read the whole database into memory, then export it
+    bibfname = _get_bibfile(entries_spec, tmpdir)
+    xmlfname = os.path.join(tmpdir, 'export.xml')
+    return _measure(lambda: export_entries(read_bibfile(bibfname), xmlfname),
+                    _count_entries(bibfname), numtop)
+
+def profile_stream(entries_spec, tmpdir, numtop):
+    bibfname = _get_bibfile(entries_spec, tmpdir)
+    xmlfname = os.path.join(tmpdir, 'export.xml')
+    return _measure(lambda: bib2enxmlstream.stream_export([bibfname], xmlfname),
+                    _count_entries(bibfname), numtop)
+
+PROFILERS = {
+    'export': profile_export,
+    'diff': profile_diff,
+    # these two start from a .bib file, to compare the regular and the streaming export
+    'bibexport': profile_bibexport,
+    'stream': profile_stream,
+    }
+
+def _run_profiler(what, entries_spec, numtop):
+    tmpdir = tempfile.mkdtemp(prefix='bib2enxml-memprofile-')
+    try:
+        return PROFILERS[what](entries_spec, tmpdir, numtop)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def run_in_child(what, entries_spec, numtop):
+    """
+    Run the given profiler in a separate process, so that each measurement starts from a
+    clean process (peak RSS cannot be reset within a process).
+    """
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    try:
+        return pool.apply(_run_profiler, (what, entries_spec, numtop))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# --------------------------------------------------
+
+def fmtbytes(n):
+    if n is None:
+        return '-'
+    return "%.1f MiB" %(n / 1048576.0)
+
+def peak_of(res):
+    return res['peak'] if res['peak'] is not None else res['peak_rss']
+
+def report(what, res, numtop):
+    n = res['records']
+    print("%-6s %8d records  %7.2f s  %8.0f rec/s  peak %10s (rss %10s)  %7.0f B/rec%s" %(
+        what, n, res['time'], n / res['time'] if res['time'] else 0.0,
+        fmtbytes(res['peak']), fmtbytes(res['peak_rss']), float(peak_of(res)) / max(n, 1),
+        ("  %.1f %s/rec" %(float(res['blocks']) / max(n, 1), res['blocks_unit'])
+         if res['blocks'] is not None else "")
+        ))
+    for line in res['top'][:numtop]:
+        print("        " + line)
+
+# below this much memory growth between the smaller sizes, measurements are mostly noise
+MIN_MEASURABLE_GROWTH = 1024*1024
+
+def fit_linear(points):
+    """
+    Least-squares fit of `y = a + b*x` to the `(x, y)` pairs `points`. Returns `(a, b)`.
+    """
+    n = float(len(points))
+    mx = sum( (x for (x, y) in points) ) / n
+    my = sum( (y for (x, y) in points) ) / n
+    sxx = sum( ((x - mx)**2 for (x, y) in points) )
+    b = (sum( ((x - mx)*(y - my) for (x, y) in points) ) / sxx) if sxx else 0.0
+    return (my - b*mx, b)
+
+def check_growth(what, results, max_growth):
+    """
+    Return `False` if peak memory grows faster than linearly in the number of records.
+
+    Peak memory is fitted as a fixed overhead plus a cost per record on all but the
+    largest run, and the memory used beyond the fixed overhead by the largest run may not
+    exceed `max_growth` times what the fit predicts. This needs at least three sizes, and
+    the fitted growth over the smaller sizes must be at least `MIN_MEASURABLE_GROWTH`:
+    otherwise the ratio would only compare noise.
+    """
+    if len(results) < 3:
+        print("%s: need at least 3 sizes to check memory growth" %(what))
+        return True
+    (a, b) = fit_linear([ (res['records'], peak_of(res)) for res in results[:-1] ])
+    if b * (results[-2]['records'] - results[0]['records']) < MIN_MEASURABLE_GROWTH:
+        print("%s: memory growth between %d and %d records too small to compare, skipping "
+              "growth check" %(what, results[0]['records'], results[-2]['records']))
+        return True
+    last = results[-1]
+    expected = b * last['records']
+    actual = peak_of(last) - a
+    growth = actual / expected
+    if growth > max_growth:
+        print("%s: SUPERLINEAR memory growth up to %d records: %.2fx the linear "
+              "expectation (%.0f B/rec beyond a fixed overhead of %s, expected %.0f B/rec)"
+              %(what, last['records'], growth, actual / last['records'], fmtbytes(a), b))
+        return False
+    return True
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        prog='memprofile',
+        description='Profile the memory used by the bib2enxml export and by diffendnoteex2xml',
+        )
+    parser.add_argument('-n', '--sizes', dest='sizes', action='store', type=int, nargs='+',
+                        default=[500, 1000, 2000, 4000],
+                        help='numbers of synthetic records to profile with')
+    parser.add_argument('-b', '--bibfile', dest='bibfile', action='store', default=None,
+                        help='profile with the entries of this .bib file instead of '
+                        'synthetic entries (e.g. to compare before/after a change)')
+    parser.add_argument('-p', '--profile', dest='profiles', action='append', default=None,
+                        choices=sorted(PROFILERS.keys()),
+                        help='what to profile (default: all)')
+    parser.add_argument('-t', '--top', dest='top', action='store', type=int, default=5,
+                        help='number of top allocation sites to show')
+    parser.add_argument('-g', '--max-growth', dest='max_growth', action='store', type=float,
+                        default=1.5,
+                        help='fail if peak memory grows more than this factor faster than '
+                        'the number of records')
+
+    args = parser.parse_args(argv)
+
+    if tracemalloc is None:
+        print("tracemalloc not available: reporting peak RSS, and counts of objects "
+              "(containers and instances, not strings) near the peak instead of allocations.")
+
+    ok = True
+    for what in (args.profiles or sorted(PROFILERS.keys())):
+        if args.bibfile:
+            report(what, run_in_child(what, args.bibfile, args.top), args.top)
+            continue
+        results = []
+        for n in sorted(args.sizes):
+            res = run_in_child(what, n, args.top)
+            report(what, res, args.top)
+            results.append(res)
+        ok = check_growth(what, results, args.max_growth) and ok
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
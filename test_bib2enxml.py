@@ -0,0 +1,120 @@
+
+# Tests for the bib2enxml filter. Run with `python -m unittest test_bib2enxml'.
+
+from __future__ import unicode_literals, print_function
+
+import re
+import unittest
+import StringIO
+
+from pybtex.database import Entry, Person
+
+import bib2enxml
+
+
+class NoArxivInfo(object):
+    def getArXivInfo(self, entrykey):
+        return None
+
+
+def make_entry(key, type_, persons={}, **fields):
+    entry = Entry(type_, fields=fields)
+    entry.key = key
+    for (role, names) in persons.items():
+        for name in names:
+            entry.add_person(Person(name), role)
+    return entry
+
+def export(entries, **kwargs):
+    filtr = bib2enxml.Bib2EnXmlFilter(xmlfile='unused.xml', **kwargs)
+    fobj = StringIO.StringIO()
+    filtr.write_records(fobj, entries, NoArxivInfo())
+    return fobj.getvalue()
+
+def tag_values(xml, tag):
+    return re.findall(r'<' + tag + r'><style[^>]*>(.*?)</style></' + tag + r'>', xml)
+
+
+class TestCrossref(unittest.TestCase):
+
+    def setUp(self):
+        self.parent = make_entry(
+            'proc2001', 'proceedings',
+            persons={'editor': ['Editor, Ed']},
+            title="Proceedings of the Conference",
+            series="Lecture Notes in Computer Science",
+            publisher="Springer",
+            year="2001",
+            )
+        self.child = make_entry(
+            'talk2001', 'inproceedings',
+            persons={'author': ['Author, Au']},
+            title="A Talk",
+            pages="1--10",
+            crossref="proc2001",
+            )
+        entries = {'proc2001': self.parent, 'talk2001': self.child}
+        self.resolver = bib2enxml.CrossrefResolver(entries)
+
+    def test_booktitle_from_parent_title_wins_over_series(self):
+        xml = export([ self.resolver.resolve(self.child) ])
+        self.assertEqual(tag_values(xml, 'secondary-title'),
+                         ["Proceedings of the Conference"])
+        self.assertEqual(tag_values(xml, 'title'), ["A Talk"])
+
+    def test_inherited_fields_and_persons(self):
+        resolved = self.resolver.resolve(self.child)
+        self.assertNotIn('crossref', resolved.fields)
+        self.assertEqual(resolved.fields['year'], "2001")
+        self.assertEqual(resolved.fields['publisher'], "Springer")
+        self.assertEqual([ unicode(p) for p in resolved.persons['editor'] ], ["Editor, Ed"])
+
+    def test_child_booktitle_is_kept(self):
+        child = make_entry('talk2', 'inproceedings', title="Another Talk",
+                           booktitle="Proc. Conf.", crossref="proc2001")
+        resolver = bib2enxml.CrossrefResolver({'proc2001': self.parent, 'talk2': child})
+        xml = export([ resolver.resolve(child) ])
+        self.assertEqual(tag_values(xml, 'secondary-title'), ["Proc. Conf."])
+
+
+class TestCrossrefChains(unittest.TestCase):
+
+    def resolver(self, *entries):
+        return bib2enxml.CrossrefResolver(dict( ( (e.key, e) for e in entries ) ))
+
+    def test_chain(self):
+        a = make_entry('a', 'inproceedings', title="A", crossref="b")
+        b = make_entry('b', 'proceedings', title="B", crossref="c")
+        c = make_entry('c', 'book', title="C", publisher="Pub", year="2001")
+        resolver = self.resolver(a, b, c)
+        resolved = resolver.resolve(a)
+        # the direct parent's title, not the one b inherits from c
+        self.assertEqual(resolved.fields['booktitle'], "B")
+        self.assertEqual(resolved.fields['publisher'], "Pub")
+        self.assertEqual(resolved.fields['year'], "2001")
+        self.assertNotIn('crossref', resolved.fields)
+        self.assertEqual(resolver.resolve(b).fields['booktitle'], "C")
+        xml = export([ resolved ])
+        self.assertEqual(tag_values(xml, 'secondary-title'), ["B"])
+
+    def test_cycle(self):
+        x = make_entry('x', 'inproceedings', title="X", note="from x", crossref="y")
+        y = make_entry('y', 'proceedings', title="Y", year="2002", crossref="x")
+        resolver = self.resolver(x, y)
+        resolved = resolver.resolve(x)
+        self.assertEqual(resolved.fields['year'], "2002")
+        self.assertEqual(resolved.fields['booktitle'], "Y")
+        # the cycle is broken: y is left as it is
+        self.assertIs(resolver.resolve(y), y)
+
+    def test_self_reference(self):
+        z = make_entry('z', 'article', title="Z", crossref="z")
+        self.assertIs(self.resolver(z).resolve(z), z)
+
+    def test_missing_parent(self):
+        m = make_entry('m', 'inproceedings', title="M", crossref="nonexistent")
+        self.assertIs(self.resolver(m).resolve(m), m)
+
+
+if __name__ == '__main__':
+    unittest.main()
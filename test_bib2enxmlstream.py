@@ -0,0 +1,39 @@
+
+# Tests for the streaming export. Run with `python -m unittest test_bib2enxmlstream'.
+
+from __future__ import unicode_literals, print_function
+
+import io
+import unittest
+
+import bib2enxmlstream
+
+
+def chunks(text):
+    return list(bib2enxmlstream.iter_bibtex_chunks(io.StringIO(text)))
+
+
+class TestBibtexChunks(unittest.TestCase):
+
+    def test_parenthesis_in_quoted_string(self):
+        self.assertEqual(
+            chunks('@article(k2, title = "Paren (x) here", year=2001)\n'),
+            ['@article(k2, title = "Paren (x) here", year=2001)'])
+
+    def test_closing_delimiters_in_braces_and_strings(self):
+        text = ('junk @string{jx = "Journal (X)"}\n'
+                '@article(k4, title = {Braced ) paren}, note = "q {"}x" # ")")\n'
+                '@article{k5,\n  title = {Multi\n  line},\n  year = 2005\n}\n')
+        self.assertEqual(chunks(text), [
+            '@string{jx = "Journal (X)"}',
+            '@article(k4, title = {Braced ) paren}, note = "q {"}x" # ")")',
+            '@article{k5,\n  title = {Multi\n  line},\n  year = 2005\n}',
+            ])
+
+    def test_comment_is_not_bibtex(self):
+        self.assertEqual(chunks('@comment(don\'t "mind (me)) @misc{k6}'),
+                         ['@comment(don\'t "mind (me))', '@misc{k6}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
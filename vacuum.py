@@ -11,13 +11,17 @@ import logging
 try:
     # bibolamazi v3
     from bibolamazi.core.bibfilter import BibFilter, BibFilterError
+    from bibolamazi.core.butils import getbool
+    from bibolamazi.filters.util import arxivutil
     from pylatexenc import latex2text
     logger = logging.getLogger(__name__)
 except ImportError:
     # bibolamazi v2
     from core.bibfilter import BibFilter, BibFilterError
+    from core.butils import getbool
     from core.blogger import logger
     from core.pylatexenc import latex2text
+    from filters.util import arxivutil
 
 
 
@@ -35,6 +39,10 @@ after, e.g., bib2enxml filter.
 HELP_TEXT = u"""
 Very simple. Leaves no database entry behind. Saves space in the bibolamazi file. Very
 clean.
+
+With `-dCompactCache', the arXiv caches are also cleaned up: information about entries
+which are no longer in the database, and fetched arXiv API information which no remaining
+entry refers to, are removed from the cache before vacuuming.
 """
 
 
@@ -44,13 +52,21 @@ class VacuumFilter(BibFilter):
     helpdescription = HELP_DESC
     helptext = HELP_TEXT
 
-    def __init__(self):
+    def __init__(self, compact_cache=False):
         """
         Vacuum filter constructor.
+
+        Arguments:
+
+         - compact_cache(bool): If set to `True`, then also remove from the arXiv caches
+           all information about entries which are not in the database any more (the
+           database as it is just before vacuuming).
         """
 
         BibFilter.__init__(self);
 
+        self.compact_cache = getbool(compact_cache)
+
 
     def name(self):
         return "vacuum"
@@ -62,11 +78,53 @@ class VacuumFilter(BibFilter):
         return BibFilter.BIB_FILTER_BIBOLAMAZIFILE;
 
 
+    def requested_cache_accessors(self):
+        if not self.compact_cache:
+            return []
+        return [
+            arxivutil.ArxivInfoCacheAccessor,
+            arxivutil.ArxivFetchedAPIInfoCacheAccessor
+            ]
+
+    def compact_arxiv_cache(self, bibolamazifile):
+        """
+        Remove from the arXiv caches all information which is not relevant to any entry of
+        the current database of `bibolamazifile`.
+        """
+
+        entries = bibolamazifile.bibliographyData().entries
+
+        arxivinfodic = bibolamazifile.cacheAccessor(arxivutil.ArxivInfoCacheAccessor).cacheDic()
+        fetchedinfodic = \
+            bibolamazifile.cacheAccessor(arxivutil.ArxivFetchedAPIInfoCacheAccessor).cacheDic()
+
+        # arXiv info for entries which have been removed from the database
+        entrydic = arxivinfodic['entries']
+        stale_keys = [ key for key in entrydic if key not in entries ]
+        for key in stale_keys:
+            del entrydic[key]
+
+        # fetched arXiv API info which no remaining entry refers to
+        used_arxivids = set( (info['arxivid'] for info in entrydic.values()
+                              if info and info.get('arxivid')) )
+        fetcheddic = fetchedinfodic['fetched']
+        stale_arxivids = [ arxivid for arxivid in fetcheddic if arxivid not in used_arxivids ]
+        for arxivid in stale_arxivids:
+            del fetcheddic[arxivid]
+
+        logger.info("vacuum: removed %d stale arXiv info and %d stale arXiv API cache entries",
+                    len(stale_keys), len(stale_arxivids))
+
+
     def filter_bibolamazifile(self, bibolamazifile):
         #
         # bibdata is a pybtex.database.BibliographyData object
         #
 
+        if self.compact_cache:
+            # must be done while we still know which entries are in the database
+            self.compact_arxiv_cache(bibolamazifile)
+
         bibdata = BibliographyData()
 
         bibolamazifile.setBibliographyData(bibdata)